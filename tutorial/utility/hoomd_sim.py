@@ -1,38 +1,56 @@
-def mie_fluid(it, m, spacing, name, timestep, n, sigma, epsilon, kbT, density, eq_time, production_time):
-    import math
-    import numpy as np
-    import itertools
-    import hoomd
-    import gsd.hoomd
-    
+import os
+import math
+import hashlib
+
+import numpy as np
+import hoomd
+import gsd.hoomd
+
+def lattice_gsd(it, m, spacing, name):
+    # Sweeps that only change the potential or state point share one lattice file
+    sig = hashlib.blake2b(f'{m}-{spacing!r}-{name}'.encode()).hexdigest()[:8]
+    filename = 'lattice_' + sig + '.gsd'
+    if os.path.exists(filename):
+        return filename
+
     # Initial configuration setup
     N_particles = 4 * m**3
     K = math.ceil(N_particles**(1 / 3))
-    L = K * spacing * sigma
+    L = K * spacing
     x = np.linspace(-L / 2, L / 2, K, endpoint=False)
-    position = list(itertools.product(x, repeat=3))
+    XX, YY, ZZ = np.meshgrid(x, x, x, indexing='ij')
+    position = np.column_stack([XX.ravel(), YY.ravel(), ZZ.ravel()])[:N_particles]
 
     # Create the snapshot in GSD for hoomd to read in l8r
     snapshot = gsd.hoomd.Frame()
     snapshot.particles.N = N_particles
-    snapshot.particles.position = position[0:N_particles]
+    snapshot.particles.position = position
     snapshot.particles.typeid = [0] * N_particles
     snapshot.configuration.box = [L, L, L, 0, 0, 0]
     snapshot.particles.types = [name]
-    with gsd.hoomd.open(name='lattice' + str(it) +'.gsd', mode='w') as f:
+    # Write under a per-run name first so concurrent runs never read a partial file
+    tmp_filename = 'lattice_' + sig + '_' + str(it) + '.gsd'
+    with gsd.hoomd.open(name=tmp_filename, mode='w') as f:
         f.append(snapshot)
+    os.replace(tmp_filename, filename)
+    return filename
+
+def mie_fluid(it, m, spacing, name, timestep, n, sigma, epsilon, kbT, density, eq_time, production_time):
+    # Initial configuration setup
+    lattice = lattice_gsd(it, m, spacing * sigma, name)
 
     # Pair hoomd to the cpu and create basic sim objects
     cpu = hoomd.device.CPU()
     sim = hoomd.Simulation(device=cpu, seed=1)
-    sim.create_state_from_gsd(filename='lattice' + str(it) +'.gsd')
+    sim.create_state_from_gsd(filename=lattice)
     integrator = hoomd.md.Integrator(dt = timestep)
     cell = hoomd.md.nlist.Cell(buffer=0.4)
     
     # Potential energy function
+    pair_key = (name, name)
     mie = hoomd.md.pair.Mie(nlist=cell)
-    mie.params[(name, name)] = dict(epsilon=epsilon, sigma=sigma, n=n, m=6)
-    mie.r_cut[(name, name)] = 3*sigma
+    mie.params[pair_key] = dict(epsilon=epsilon, sigma=sigma, n=n, m=6)
+    mie.r_cut[pair_key] = 3*sigma
     integrator.forces.append(mie)
     
     # Create thermostat and fix the volume to make an NVT sim
@@ -74,40 +92,24 @@ def mie_fluid(it, m, spacing, name, timestep, n, sigma, epsilon, kbT, density, e
     sim.run(production_time)
     
 def table_fluid(it, m, spacing, name, timestep, kbT, density, eq_time, production_time, V, F, rmin, rcut):
-    import math
-    import numpy as np
-    import itertools
-    import hoomd
-    import gsd.hoomd
-    
     # Initial configuration setup
-    N_particles = 4 * m**3
-    K = math.ceil(N_particles**(1 / 3))
-    L = K * spacing
-    x = np.linspace(-L / 2, L / 2, K, endpoint=False)
-    position = list(itertools.product(x, repeat=3))
-
-    # Create the snapshot in GSD for hoomd to read in l8r
-    snapshot = gsd.hoomd.Frame()
-    snapshot.particles.N = N_particles
-    snapshot.particles.position = position[0:N_particles]
-    snapshot.particles.typeid = [0] * N_particles
-    snapshot.configuration.box = [L, L, L, 0, 0, 0]
-    snapshot.particles.types = [name]
-    with gsd.hoomd.open(name='lattice' + str(it) +'.gsd', mode='w') as f:
-        f.append(snapshot)
+    lattice = lattice_gsd(it, m, spacing, name)
 
     # Pair hoomd to the cpu and create basic sim objects
     cpu = hoomd.device.CPU()
     sim = hoomd.Simulation(device=cpu, seed=1)
-    sim.create_state_from_gsd(filename='lattice' + str(it) +'.gsd')
+    sim.create_state_from_gsd(filename=lattice)
     integrator = hoomd.md.Integrator(dt = timestep)
     cell = hoomd.md.nlist.Cell(buffer=0.4)
     
     # Potential energy function
+    # HOOMD stores tables as contiguous doubles, so convert once here instead of per assignment
+    V = np.ascontiguousarray(V, dtype=np.float64)
+    F = np.ascontiguousarray(F, dtype=np.float64)
+    pair_key = (name, name)
     table = hoomd.md.pair.Table(nlist=cell)
-    table.params[(name, name)] = dict(r_min=rmin, U=V, F=F)
-    table.r_cut[(name, name)] = rcut
+    table.params[pair_key] = dict(r_min=rmin, U=V, F=F)
+    table.r_cut[pair_key] = rcut
     integrator.forces.append(table)
     
     # Create thermostat and fix the volume to make an NVT sim
@@ -1,72 +1,233 @@
+import collections
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import gsd.hoomd
+import freud
+try:
+    from numba import njit, prange
+except ImportError: # numba is optional, fall back to plain Python loops
+    def njit(*args, **kwargs):
+        return lambda f: f
+    prange = range
+
+@njit(cache=True)
+def _connected_components(bonds, N):
+    # Union-find over the bond graph; roots are always the lowest particle index in a molecule
+    parent = np.arange(N)
+    for i in range(bonds.shape[0]):
+        a = bonds[i, 0]
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        b = bonds[i, 1]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if a < b:
+            parent[b] = a
+        elif b < a:
+            parent[a] = b
+    # Parents always point to lower indices, so one forward pass flattens every tree
+    for i in range(N):
+        parent[i] = parent[parent[i]]
+    return parent
+
 def snap_molecule_indices(snap):
-    import freud
-    system = freud.AABBQuery.from_system(snap)
-    num_query_points = num_points = snap.particles.N
-    query_point_indices = snap.bonds.group[:, 0]
-    point_indices = snap.bonds.group[:, 1]
-    distances = system.box.compute_distances(
-        system.points[query_point_indices], system.points[point_indices])
-    nlist = freud.NeighborList.from_arrays(
-        num_query_points, num_points, query_point_indices, point_indices, distances)
-    cluster = freud.cluster.Cluster()
-    cluster.compute(system=system, neighbors=nlist)
-    return cluster.cluster_idx
+    bonds = np.ascontiguousarray(snap.bonds.group, dtype=np.int64).reshape(-1, 2)
+    return _connected_components(bonds, int(snap.particles.N))
 
-def intermolecular_rdf(
+def _frame_chunks(trajectory, start=0, stop=None, chunk=64):
+    # Read frames in contiguous batches rather than one seek per frame
+    indices = range(len(trajectory))[start:stop]
+    for i in range(0, len(indices), chunk):
+        yield [trajectory[j] for j in indices[i:i + chunk]]
+
+def _prefetch(chunks):
+    # Read the next batch on a worker thread while the current one is analyzed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, chunks, None)
+        while True:
+            frames = future.result()
+            if frames is None:
+                break
+            future = executor.submit(next, chunks, None)
+            yield from frames
+
+RDFResult = collections.namedtuple(
+    "RDFResult", ["bin_centers", "bin_edges", "bin_counts", "rdf"])
+
+def _partial_rdf(
     gsdfile,
-    A_name,
-    B_name,
-    start=0,
-    stop=None,
-    r_max=None,
-    r_min=0,
-    bins=1000,
-    exclude_bonded=True,):
-    import numpy as np
-    import gsd.hoomd
-    import freud
+    frames,
+    idx_A,
+    idx_B,
+    same_type,
+    molecules_A,
+    molecules_B,
+    r_max,
+    r_min,
+    bins,):
+    # Raw pair counts and summed box volume over a contiguous range of frames, so workers
+    # can be merged by summing
+    exclude_bonded = molecules_A is not None
+    rdf = freud.density.RDF(bins=bins, r_max=r_max, r_min=r_min)
+    pre_filter = post_filter = None
+    counts = np.zeros(bins, dtype=np.int64)
+    volume = 0.0 # Summed over frames
+    mask = np.empty(0, dtype=bool) # Reused across frames, grown on demand
+    box_params = None
     with gsd.hoomd.open(gsdfile) as trajectory:
-        snap = trajectory[0]
-        if r_max is None:
-            # Use a value just less than half the maximum box length.
-            r_max = np.nextafter(
-                np.max(snap.configuration.box[:3]) * 0.5, 0, dtype=np.float32)
-        rdf = freud.density.RDF(bins=bins, r_max=r_max, r_min=r_min)
-        type_A = snap.particles.typeid == snap.particles.types.index(A_name)
-        type_B = snap.particles.typeid == snap.particles.types.index(B_name)
-        if exclude_bonded:
-            molecules = snap_molecule_indices(snap)
-            molecules_A = molecules[type_A]
-            molecules_B = molecules[type_B]
-        for snap in trajectory[start:stop]:
-            A_pos = snap.particles.position[type_A]
-            if A_name == B_name:
+        for snap in _prefetch(_frame_chunks(trajectory, frames.start, frames.stop)):
+            A_pos = np.ascontiguousarray(snap.particles.position.take(idx_A, axis=0), dtype=np.float32)
+            if same_type:
                 B_pos = A_pos
                 exclude_ii = True
             else:
-                B_pos = snap.particles.position[type_B]
+                B_pos = np.ascontiguousarray(snap.particles.position.take(idx_B, axis=0), dtype=np.float32)
                 exclude_ii = False
-            box = snap.configuration.box
-            system = (box, A_pos)
-            aq = freud.locality.AABBQuery.from_system(system)
+            if box_params is None or not np.array_equal(snap.configuration.box, box_params):
+                # Production runs are NVT, so the freud box is normally built only once
+                box_params = snap.configuration.box
+                box = freud.box.Box.from_box(box_params)
+            aq = freud.locality.AABBQuery(box, A_pos)
             nlist = aq.query(
                 B_pos, {"r_max": r_max, "exclude_ii": exclude_ii}
             ).toNeighborList()
             if exclude_bonded:
                 pre_filter = len(nlist)
-                indices_A = molecules_A[nlist.point_indices]
-                indices_B = molecules_B[nlist.query_point_indices]
-                nlist.filter(indices_A != indices_B)
+                if pre_filter > len(mask):
+                    mask = np.empty(pre_filter, dtype=bool)
+                keep = mask[:pre_filter]
+                np.not_equal(
+                    molecules_A[nlist.point_indices],
+                    molecules_B[nlist.query_point_indices],
+                    out=keep)
+                nlist.filter(keep)
                 post_filter = len(nlist)
-            rdf.compute(aq, neighbors=nlist, reset=False)
-        normalization = post_filter / pre_filter if exclude_bonded else 1
+            # Keep the running histogram ourselves and normalize once at the end
+            rdf.compute(aq, neighbors=nlist, reset=True)
+            counts += rdf.bin_counts
+            volume += box.volume
+    return counts, volume, len(frames), pre_filter, post_filter
+
+def _normalize_counts(bin_edges, counts, n_points, volume, n_frames):
+    # Same normalization freud.density.RDF applies when the points are also the query points
+    number_density = n_points / volume
+    shell_volumes = 4 / 3 * np.pi * np.diff(bin_edges**3)
+    return counts / (n_points * number_density * n_frames * shell_volumes)
+
+def intermolecular_rdf(
+    gsdfile,
+    A_name,
+    B_name,
+    start=0,
+    stop=None,
+    r_max=None,
+    r_min=0,
+    bins=1000,
+    exclude_bonded=True,
+    n_workers=1,):
+    with gsd.hoomd.open(gsdfile) as trajectory:
+        snap = trajectory[0]
+        frames = range(len(trajectory))[start:stop]
+    if len(frames) == 0:
+        raise ValueError(f"No frames of {gsdfile} fall between start={start} and stop={stop}")
+    if r_max is None:
+        # Use a value just less than half the maximum box length.
+        r_max = np.nextafter(
+            np.max(snap.configuration.box[:3]) * 0.5, 0, dtype=np.float32)
+    type_A = snap.particles.typeid == snap.particles.types.index(A_name)
+    type_B = snap.particles.typeid == snap.particles.types.index(B_name)
+    # Integer gathers are cheaper per frame than boolean-mask indexing
+    idx_A = np.flatnonzero(type_A)
+    idx_B = np.flatnonzero(type_B)
+    molecules_A = molecules_B = None
+    if exclude_bonded:
+        molecules = snap_molecule_indices(snap)
+        molecules_A = np.ascontiguousarray(molecules[type_A], dtype=np.int32)
+        molecules_B = np.ascontiguousarray(molecules[type_B], dtype=np.int32)
+    args = (idx_A, idx_B, A_name == B_name, molecules_A, molecules_B, r_max, r_min, bins)
+
+    # Split the frames into one contiguous block per worker
+    n_workers = max(1, min(n_workers, len(frames)))
+    bounds = np.linspace(0, len(frames), n_workers + 1).astype(int)
+    blocks = [frames[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+    if n_workers == 1:
+        partials = [_partial_rdf(gsdfile, frames, *args)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_partial_rdf, gsdfile, block, *args) for block in blocks]
+            partials = [future.result() for future in futures]
+
+    # Counts add exactly, so the merged result does not depend on n_workers
+    counts = sum(partial[0] for partial in partials)
+    n_frames = sum(partial[2] for partial in partials)
+    volume = sum(partial[1] for partial in partials) / n_frames
+    bin_edges = np.linspace(r_min, r_max, bins + 1)
+    rdf = RDFResult(
+        bin_centers=(bin_edges[:-1] + bin_edges[1:]) / 2,
+        bin_edges=bin_edges,
+        bin_counts=counts,
+        rdf=_normalize_counts(bin_edges, counts, len(idx_A), volume, n_frames))
+    pre_filter, post_filter = partials[-1][3:]
+    normalization = post_filter / pre_filter if exclude_bonded else 1
     return rdf, normalization
         
-def rdf2sq(r, rdf, Qmin, Qmax, ρ):
-    import numpy as np
-    q = np.linspace(Qmin, Qmax, 1000)
+def _trapezoid_weights(r):
     dr = r[1] - r[0] # Stepsize
-    sq   = np.zeros(len(q))
-    for j in range (len(q)):
-        sq[j] = (1 + 4*np.pi*ρ*np.trapz(r*(rdf-1)*np.sin(q[j]*r),dx = dr)/q[j])
-    return q, sq
\ No newline at end of file
+    w = np.full(len(r), dr)
+    w[[0, -1]] = 0.5*dr
+    return w
+
+@functools.lru_cache(maxsize=None)
+def _make_rdf2sq_kernel(nr, nq):
+    # Grid sizes are compile-time constants, so LLVM can fully unroll and vectorize the loops
+    @njit(parallel=True, fastmath=True, cache=True)
+    def kernel(r, v, q):
+        # Streams the sine transform one q at a time instead of building the sin(q r) matrix
+        out = np.empty(nq)
+        for j in prange(nq):
+            s = 0.0
+            for k in range(nr):
+                s += np.sin(q[j]*r[k]) * v[k]
+            out[j] = s
+        return out
+    return kernel
+
+@njit(cache=True)
+def _sin_ladder(Qmin, dq, r, nq):
+    # sin((j+1)θ + φ) = 2cos(θ)sin(jθ + φ) - sin((j-1)θ + φ) with θ = dq r, so on a uniform
+    # q grid only the first two rows need trig calls and the rest are multiply-adds
+    M = np.empty((nq, len(r)))
+    M[0] = np.sin(Qmin*r)
+    if nq > 1:
+        M[1] = np.sin((Qmin + dq)*r)
+    two_cos = 2*np.cos(dq*r)
+    for j in range(2, nq):
+        M[j] = two_cos*M[j-1] - M[j-2]
+    return M
+
+@functools.lru_cache(maxsize=16)
+def _sinqr_matrix(r_bytes, r_dtype, Qmin, Qmax, nq=1000):
+    # sin(q r) only depends on the grids, so sweeps over state points share one matrix
+    r = np.frombuffer(r_bytes, dtype=r_dtype)
+    q, dq = np.linspace(Qmin, Qmax, nq, retstep=True)
+    M = _sin_ladder(float(Qmin), float(dq), r.astype(np.float64), nq)
+    # Trapezoid weights, so the integral becomes a single dot product per q
+    w = _trapezoid_weights(r)
+    q.flags.writeable = M.flags.writeable = w.flags.writeable = False
+    return q, M, w
+
+def rdf2sq(r, rdf, Qmin, Qmax, ρ, low_memory=False):
+    if low_memory:
+        q = np.linspace(Qmin, Qmax, 1000)
+        r = np.ascontiguousarray(r, dtype=np.float64)
+        v = r*(np.asarray(rdf, dtype=np.float64)-1)*_trapezoid_weights(r)
+        kernel = _make_rdf2sq_kernel(len(r), len(q))
+        return q, 1 + 4*np.pi*ρ*kernel(r, v, q)/q
+    r = np.ascontiguousarray(r)
+    q, M, w = _sinqr_matrix(r.tobytes(), r.dtype.str, Qmin, Qmax)
+    sq = 1 + 4*np.pi*ρ*(M @ (r*(rdf-1)*w))/q
+    return q.copy(), sq
\ No newline at end of file